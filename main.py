@@ -1,38 +1,52 @@
 import argparse
+import concurrent.futures
+import io
 import os
+import platform
+import re
+import subprocess
 
 import demucs.api
 import torch
-import whisper
-from moviepy.editor import *
-from moviepy.video.tools.subtitles import SubtitlesClip
-
-from moviepy.config import change_settings
+import whisperx
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 
-from whisper.utils import get_writer
-import platform
+torch.backends.cudnn.benchmark = True
+torch.set_float32_matmul_precision("high")
 
-TRANSCRIPTION_MODEL = "medium.en"
-NUM_PASSES = 1
+TRANSCRIPTION_MODEL = "distil-large-v3"
+TRANSCRIPTION_BATCH_SIZE = 16
+SEPARATION_MODEL = "mdx_extra_q"
 VOCAL_VOLUME = 0.05
+DIM_FACTOR = 0.3
 VIDEO_WIDTH = 1280
 VIDEO_HEIGHT = 720
-TEXT_WIDTH = 1200
 TEXT_COLOR = "#FFFFFF"
 TEXT_STROKE_COLOR = "#000000"
-TEXT_STROKE_WIDTH = 0.5
 FONT_SIZE = 40
-FONT = "./fonts/kg.ttf"
+FONTS_DIR = "./fonts"
+FONT_NAME = "KG What the Teacher Wants"
+
 
+def _ass_color(hex_color: str) -> str:
+    """Converts an #RRGGBB hex color to the &HAABBGGRR form libass expects."""
+    red, green, blue = hex_color[1:3], hex_color[3:5], hex_color[5:7]
+    return f"&H00{blue}{green}{red}".upper()
 
-if platform.system() == "Darwin":
-    imagemagick_path = "/opt/homebrew/bin/magick"
-elif platform.system() == "Windows":
-    imagemagick_path = "C:/Program Files/ImageMagick-7.1.1-Q16-HDRI/magick.exe"
-else:
-    raise NotImplementedError("Unsupported operating system")
 
-change_settings({"IMAGEMAGICK_BINARY": imagemagick_path})
+SUBTITLE_STYLE = (
+    f"PlayResX={VIDEO_WIDTH},"
+    f"PlayResY={VIDEO_HEIGHT},"
+    f"FontName={FONT_NAME},"
+    f"FontSize={FONT_SIZE},"
+    f"PrimaryColour={_ass_color(TEXT_COLOR)},"
+    f"OutlineColour={_ass_color(TEXT_STROKE_COLOR)},"
+    f"Outline=1,Alignment=5"
+)
+
+_BATCHED_MODEL = None
+_ALIGN_MODEL = None
+_ALIGN_METADATA = None
 
 
 def video_to_mp3(video_path: str):
@@ -42,8 +56,10 @@ def video_to_mp3(video_path: str):
     if os.path.exists(audio_path):
         return audio_path
 
-    audio = AudioFileClip(video_path)
-    audio.write_audiofile(audio_path, logger="bar")
+    subprocess.run([
+        "ffmpeg", "-y", "-i", video_path,
+        "-vn", "-acodec", "libmp3lame", "-q:a", "2", audio_path,
+    ], check=True)
     print(f"Audio saved to: {audio_path}")
     return audio_path
 
@@ -61,9 +77,19 @@ def separate_stems(audio_file_path: str) -> tuple[str, str]:
 
     print(f"Separating vocals from {audio_file_path}")
 
-    separator = demucs.api.Separator(progress=True, jobs=4)
+    separator = demucs.api.Separator(
+        model=SEPARATION_MODEL, segment=60, overlap=0.1,
+        jobs=max(1, (os.cpu_count() or 2) // 2), progress=True)
+
+    if torch.cuda.is_available():
+        # Compile forward only: the bag is walked by isinstance checks in
+        # apply_model, so the module objects themselves must stay intact.
+        for sub_model in separator.model.models:
+            sub_model.forward = torch.compile(
+                sub_model.forward, mode="reduce-overhead")
 
-    _, separated = separator.separate_audio_file(audio_file_path)
+    with torch.inference_mode():
+        _, separated = separator.separate_audio_file(audio_file_path)
 
     for stem, source in separated.items():
         demucs.api.save_audio(
@@ -75,20 +101,112 @@ def separate_stems(audio_file_path: str) -> tuple[str, str]:
     return f"./stems/vocals_{audio_filename}", f"./stems/music_{audio_filename}"
 
 
-def transcribe(audiofile_path: str, num_passes: int = 1) -> str:
+def _segments_to_whisper_result(segments, info) -> dict:
+    """Converts faster-whisper segments to whisper's result dict schema.
+
+    Args:
+        segments: Iterable of faster-whisper Segment objects.
+        info: The TranscriptionInfo returned alongside the segments.
+
+    Returns:
+        dict: A result dict compatible with whisper's SRT writer.
+    """
+    result_segments = []
+    for segment in segments:
+        result_segments.append({
+            "start": segment.start,
+            "end": segment.end,
+            "text": segment.text,
+            "words": [
+                {"start": word.start, "end": word.end,
+                    "word": word.word, "probability": word.probability}
+                for word in segment.words or []
+            ],
+        })
+
+    return {"segments": result_segments, "language": info.language}
+
+
+def _aligned_to_whisper_result(aligned: dict) -> dict:
+    """Converts a whisperx alignment result to whisper's result dict schema.
+
+    Args:
+        aligned (dict): The result returned by whisperx.align.
+
+    Returns:
+        dict: A result dict compatible with whisper's SRT writer.
+    """
+    result_segments = []
+    for segment in aligned["segments"]:
+        result_segments.append({
+            "start": segment["start"],
+            "end": segment["end"],
+            "text": segment["text"],
+            "words": [
+                word for word in segment.get("words", [])
+                if "start" in word and "end" in word
+            ],
+        })
+
+    return {"segments": result_segments, "language": "en"}
+
+
+def _format_timestamp(seconds: float) -> str:
+    """Formats seconds as an SRT hh:mm:ss,mmm timestamp."""
+    milliseconds = round(seconds * 1000)
+    hours, milliseconds = divmod(milliseconds, 3_600_000)
+    minutes, milliseconds = divmod(milliseconds, 60_000)
+    secs, milliseconds = divmod(milliseconds, 1_000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d},{milliseconds:03d}"
+
+
+def _write_srt(result: dict, subtitle_path: str) -> None:
+    """Writes one SRT cue per aligned word to subtitle_path.
+
+    Each word becomes its own cue spanning its aligned timestamps, giving
+    the karaoke-style word timing without re-echoing the whole line per
+    cue. Segments with no aligned words fall back to a segment-level cue.
+
+    Args:
+        result (dict): A whisper-schema result dict with a "segments" list.
+        subtitle_path (str): Destination path for the SRT file.
+    """
+    buffer = io.StringIO()
+    index = 1
+    for segment in result["segments"]:
+        words = segment["words"] or [{
+            "start": segment["start"],
+            "end": segment["end"],
+            "word": segment["text"],
+        }]
+        for word in words:
+            start = _format_timestamp(word["start"])
+            end = _format_timestamp(word["end"])
+            buffer.write(f"{index}\n{start} --> {end}\n{word['word'].strip()}\n\n")
+            index += 1
+
+    with open(subtitle_path, "w", encoding="utf-8") as srt_file:
+        srt_file.write(buffer.getvalue())
+
+
+def transcribe(audiofile_path: str) -> str:
     """
     Converts an MP3 file to a transcript using Whisper
 
     Args:
         audiofile_path (str): The file path of the MP3 file to be processed.
-        num_passes (int): Number of transcription passes to perform.
     Returns:
-        str: The path to the SRT file containing the transcript from the last pass.
+        str: The path to the SRT file containing the transcript.
     """
+    global _BATCHED_MODEL, _ALIGN_MODEL, _ALIGN_METADATA
+
     try:
 
-        subtitle_path = os.path.join("./subtitles", os.path.splitext(
-            os.path.basename(audiofile_path))[0] + '.srt')
+        # The path is interpolated into an ffmpeg filtergraph, so keep it
+        # free of the characters the graph parser reserves ([],;:'\ etc.).
+        subtitle_name = re.sub(r"[^\w-]+", "_", os.path.splitext(
+            os.path.basename(audiofile_path))[0])
+        subtitle_path = os.path.join("./subtitles", subtitle_name + '.srt')
 
         if os.path.exists(subtitle_path):
             return subtitle_path
@@ -97,20 +215,30 @@ def transcribe(audiofile_path: str, num_passes: int = 1) -> str:
             os.makedirs("./subtitles")
 
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        model = whisper.load_model(TRANSCRIPTION_MODEL).to(device)
-
-        last_result = None
-        for i in range(num_passes):
-            print(f"Transcription pass {i + 1} of {num_passes}...")
-            current_result = model.transcribe(
-                audiofile_path, verbose=True, language="en", word_timestamps=True)
-            last_result = current_result
-
-        if last_result is None:
-            raise ValueError("No transcription results obtained.")
-
-        srt_writer = get_writer("srt", "./subtitles")
-        srt_writer(last_result, audiofile_path, highlight_words=True)
+        if _BATCHED_MODEL is None:
+            compute_type = 'float16' if device == 'cuda' else 'int8'
+            model = WhisperModel(TRANSCRIPTION_MODEL,
+                                 device=device, compute_type=compute_type)
+            _BATCHED_MODEL = BatchedInferencePipeline(model=model)
+
+        audio = whisperx.load_audio(audiofile_path)
+
+        print("Transcribing...")
+        segments, info = _BATCHED_MODEL.transcribe(
+            audio, language="en", word_timestamps=False,
+            batch_size=TRANSCRIPTION_BATCH_SIZE, beam_size=1,
+            vad_filter=True)
+        last_result = _segments_to_whisper_result(segments, info)
+
+        if _ALIGN_MODEL is None:
+            _ALIGN_MODEL, _ALIGN_METADATA = whisperx.load_align_model(
+                language_code="en", device=device)
+        with torch.inference_mode():
+            aligned = whisperx.align(
+                last_result["segments"], _ALIGN_MODEL, _ALIGN_METADATA, audio, device)
+        last_result = _aligned_to_whisper_result(aligned)
+
+        _write_srt(last_result, subtitle_path)
 
         return subtitle_path
 
@@ -119,6 +247,20 @@ def transcribe(audiofile_path: str, num_passes: int = 1) -> str:
         return ""
 
 
+def _video_encoder_args() -> list[str]:
+    """Picks a hardware H.264 encoder when one is available.
+
+    Returns:
+        list[str]: ffmpeg arguments selecting the video encoder.
+    """
+    if platform.system() == "Darwin":
+        return ["-c:v", "h264_videotoolbox", "-b:v", "5M"]
+    if torch.cuda.is_available():
+        return ["-c:v", "h264_nvenc", "-preset", "p5",
+                "-rc", "vbr", "-cq", "23", "-b:v", "5M"]
+    return ["-c:v", "libx264"]
+
+
 def create(video_path: str):
     """Creates a karaoke video from the separated audio files and the original video file.
 
@@ -131,54 +273,31 @@ def create(video_path: str):
 
     audio_path = video_to_mp3(video_path)
 
-    vocals_path, music_path = separate_stems(audio_path)
-
-    music = AudioFileClip(music_path).set_fps(44100)
-    vocals_audio = AudioFileClip(vocals_path).volumex(
-        VOCAL_VOLUME).set_fps(44100)
-
-    combined_audio = CompositeAudioClip([music, vocals_audio])
-
-    background_video = VideoFileClip(video_path, target_resolution=(VIDEO_HEIGHT, VIDEO_HEIGHT)).set_fps(
-        30).set_duration(combined_audio.duration)
-
-    dimmed_background_video = background_video.fl_image(
-        lambda image: (image * 0.3).astype("uint8"))
-
-    subtitles_file = transcribe(vocals_path, NUM_PASSES)
-
-    def generator(txt):
-        """Generates the subtitles for the karaoke video.
-
-        Args:
-            txt (str): The text to be added to the subtitles.
-
-        Returns:
-            TextClip: The subtitle text clip.
-        """
-
-        return TextClip(
-            txt,
-            font=FONT,
-            fontsize=FONT_SIZE,
-            color=TEXT_COLOR,
-            stroke_color=TEXT_STROKE_COLOR,
-            stroke_width=TEXT_STROKE_WIDTH,
-            size=(TEXT_WIDTH, None),
-            method='pango'
-        )
-
-    subtitles = SubtitlesClip(subtitles_file, generator)
-
-    result = CompositeVideoClip([
-        dimmed_background_video,
-        subtitles.set_position(('center', 'center'), relative=True)
-    ]).set_audio(combined_audio)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        stems_future = executor.submit(separate_stems, audio_path)
+        subtitles_file = transcribe(audio_path)
+        vocals_path, music_path = stems_future.result()
 
     filename = f"karaoke_{os.path.basename(video_path)}"
     if not os.path.exists("./output"):
         os.makedirs("./output")
-    result.write_videofile(f"./output/{filename}", fps=30, threads=4)
+
+    filter_complex = (
+        f"[0:v]scale={VIDEO_WIDTH}:{VIDEO_HEIGHT},fps=30,"
+        f"lutrgb=r=val*{DIM_FACTOR}:g=val*{DIM_FACTOR}:b=val*{DIM_FACTOR},"
+        f"subtitles={subtitles_file}:fontsdir={FONTS_DIR}:"
+        f"force_style='{SUBTITLE_STYLE}'[v];"
+        f"[1:a][2:a]amix=inputs=2:weights='1 {VOCAL_VOLUME}'[a]"
+    )
+
+    subprocess.run([
+        "ffmpeg", "-y",
+        "-i", video_path, "-i", music_path, "-i", vocals_path,
+        "-filter_complex", filter_complex,
+        "-map", "[v]", "-map", "[a]",
+        *_video_encoder_args(), "-c:a", "aac",
+        "-shortest", f"./output/{filename}",
+    ], check=True)
 
     return filename
 